@@ -2,7 +2,6 @@ import os
 import re
 import time
 import threading
-from collections import defaultdict
 from typing import List
 from dotenv import load_dotenv
 from langchain_huggingface import HuggingFaceEndpointEmbeddings
@@ -11,7 +10,9 @@ from langchain.schema import Document
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
 from langchain.memory import ConversationSummaryBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
 from langchain.chains import ConversationalRetrievalChain
+from pydantic import PrivateAttr
 from google.api_core.exceptions import ResourceExhausted
 
 # load env & HF caches
@@ -36,6 +37,11 @@ os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY", "")
 user_memory_store = {}
 user_last_player = {}
 
+# 記憶模式："sync" = 每次 invoke 內同步摘要（原行為）；"async" = 回覆推送後再於背景摘要
+MEMORY_MODE = os.getenv("MEMORY_MODE", "sync").strip().lower()
+# 摘要用模型（async 模式可改用較便宜/快速的模型，例如 gemini-2.5-flash）
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gemini-2.5-pro")
+
 # players list
 all_players = [
     "Brady Singer", "Lance Lynn", "Devin Williams", "Adam Wainwright",
@@ -70,6 +76,95 @@ template = """
 """
 prompt = PromptTemplate(template=template, input_variables=["context", "question"])
 
+class DeferredSummaryBufferMemory(ConversationSummaryBufferMemory):
+    # save_context 時只寫入對話、不做摘要（prune），摘要改由 schedule_memory_summary 於背景執行。
+    # 鎖只保護讀寫記憶的瞬間，不會在 LLM 呼叫期間持有，背景摘要不會擋住下一次提問。
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _summarizing: bool = PrivateAttr(default=False)
+
+    def begin_summary(self) -> bool:
+        # 已有背景摘要在跑就回傳 False，避免同一段溢出被重複摘要（浪費一次 LLM 呼叫）
+        with self._lock:
+            if self._summarizing:
+                return False
+            self._summarizing = True
+            return True
+
+    def end_summary(self) -> None:
+        with self._lock:
+            self._summarizing = False
+
+    def load_memory_variables(self, inputs):
+        with self._lock:
+            return super().load_memory_variables(inputs)
+
+    def save_context(self, inputs, outputs) -> None:
+        with self._lock:
+            BaseChatMemory.save_context(self, inputs, outputs)
+
+    def summarize_overflow(self) -> int:
+        # 在副本上計算要摘要的舊訊息並產生新摘要；成功後才寫回，失敗時記憶保持原樣以便下次重試。
+        # 回傳被摘要掉的訊息數。
+        with self._lock:
+            buffer = list(self.chat_memory.messages)
+            summary = self.moving_summary_buffer
+
+        curr_len = self.llm.get_num_tokens_from_messages(buffer)
+        if curr_len <= self.max_token_limit:
+            return 0
+        pruned = []
+        while buffer and curr_len > self.max_token_limit:
+            pruned.append(buffer.pop(0))
+            curr_len = self.llm.get_num_tokens_from_messages(buffer)
+        new_summary = self.predict_new_summary(pruned, summary)
+
+        with self._lock:
+            current = self.chat_memory.messages
+            # 摘要期間記憶若被其他流程改寫（非單純新增訊息），放棄這次結果
+            unchanged = (
+                self.moving_summary_buffer == summary
+                and len(current) >= len(pruned)
+                and all(a is b for a, b in zip(current, pruned))
+            )
+            if not unchanged:
+                return 0
+            del current[:len(pruned)]
+            self.moving_summary_buffer = new_summary
+        return len(pruned)
+
+def _summarize_memory(user_id: str, memory: DeferredSummaryBufferMemory):
+    try:
+        removed = memory.summarize_overflow()
+        if removed:
+            print(f"📝 背景摘要完成 {user_id}：摘要 {removed} 則舊訊息")
+    except ResourceExhausted:
+        print(f"⚠️ 背景摘要遇到 API 配額限制，記憶保持原樣，下次再摘要（{user_id}）")
+    except Exception as e:
+        print(f"❌ 背景摘要失敗，記憶保持原樣（{user_id}）：{e}")
+    finally:
+        memory.end_summary()
+
+def schedule_memory_summary(user_id: str = "default"):
+
+    # 於回覆推送後呼叫：async 模式下在背景執行緒壓縮該使用者的記憶；sync 模式下不做事。
+
+    if MEMORY_MODE != "async":
+        return
+    memory = user_memory_store.get(user_id)
+    if not isinstance(memory, DeferredSummaryBufferMemory):
+        return
+    if not memory.begin_summary():
+        print(f"⏭️ {user_id} 已有背景摘要進行中，略過本次排程")
+        return
+    try:
+        t = threading.Thread(target=_summarize_memory, args=(user_id, memory))
+        t.daemon = True
+        t.start()
+    except Exception:
+        memory.end_summary()
+        raise
+
 def init_vectordb_if_needed():
     global embedding, vectordb, _vectordb_lock
     if _vectordb_lock is None:
@@ -227,9 +322,10 @@ def get_answer(question: str, player_name: list = None, user_id: str = "default"
 
     # memory init
     if user_id not in user_memory_store:
-        print(f"🔰 為使用者 {user_id} 建立新的記憶池")
-        memory = ConversationSummaryBufferMemory(
-            llm=ChatGoogleGenerativeAI(model="gemini-2.5-pro", temperature=0),
+        print(f"🔰 為使用者 {user_id} 建立新的記憶池（mode={MEMORY_MODE}）")
+        memory_cls = DeferredSummaryBufferMemory if MEMORY_MODE == "async" else ConversationSummaryBufferMemory
+        memory = memory_cls(
+            llm=ChatGoogleGenerativeAI(model=SUMMARY_MODEL, temperature=0),
             memory_key="chat_history",
             return_messages=True
         )
@@ -239,11 +335,17 @@ def get_answer(question: str, player_name: list = None, user_id: str = "default"
         memory = user_memory_store[user_id]
 
     llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro", temperature=0)
+    chain_kwargs = {}
+    if extracted_players:
+        # 問題中已明確指定球員，不需再用歷史改寫問題（省一次 LLM 呼叫）
+        print("⏭️ 問題已指名球員，略過問題改寫（condense question）")
+        chain_kwargs["get_chat_history"] = lambda history: ""
     qa_chain = ConversationalRetrievalChain.from_llm(
         llm=llm,
         retriever=retriever,
         memory=memory,
         combine_docs_chain_kwargs={"prompt": prompt},
+        **chain_kwargs,
     )
 
     for attempt in range(9):
@@ -0,0 +1,244 @@
+import os
+import re
+import gzip
+import heapq
+import sqlite3
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+# 長回答下載檔的儲存層：
+# - 後端可替換（SQLite 檔案 / 本機資料夾），SQLite 可讓同一台機器上的多個 gunicorn worker 共用
+# - 可選 gzip 壓縮儲存，下載時若 client 支援就直接以 Content-Encoding: gzip 回傳
+# - 單一 sweeper 執行緒以 heap 排序到期時間，取代每個檔案各一個 threading.Timer
+# - 啟動時先清掉過期檔案，避免重啟後留下孤兒檔
+
+# put() 中斷留下的 .tmp 檔，超過此秒數視為孤兒檔清除
+TMP_ORPHAN_AGE_S = 3600
+# 舊版（每檔一個 Timer）留下的 <uuid>.txt
+_LEGACY_FILE_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.txt$")
+
+
+class DownloadStore(ABC):
+    # 後端介面：data 為已編碼的 bytes，encoding 為 "gzip" 或 "identity"
+
+    @abstractmethod
+    def put(self, file_id: str, data: bytes, encoding: str, expires_at: float) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, file_id: str) -> Optional[Tuple[bytes, str]]:
+        ...
+
+    @abstractmethod
+    def purge_expired(self, now: float) -> int:
+        ...
+
+
+class SQLiteDownloadStore(DownloadStore):
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "file_id TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                "encoding TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_expires ON downloads(expires_at)")
+
+    @contextmanager
+    def _connect(self):
+        # 每次操作各自開連線（commit 後關閉），跨執行緒/跨 worker 都安全
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def put(self, file_id, data, encoding, expires_at):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO downloads (file_id, data, encoding, expires_at) VALUES (?, ?, ?, ?)",
+                (file_id, sqlite3.Binary(data), encoding, expires_at),
+            )
+
+    def get(self, file_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data, encoding FROM downloads WHERE file_id = ? AND expires_at > ?",
+                (file_id, time.time()),
+            ).fetchone()
+        if not row:
+            return None
+        return bytes(row[0]), row[1]
+
+    def purge_expired(self, now):
+        with self._connect() as conn:
+            cur = conn.execute("DELETE FROM downloads WHERE expires_at <= ?", (now,))
+            return cur.rowcount
+
+
+class LocalDirDownloadStore(DownloadStore):
+    # 沿用原本 /tmp/line_downloads 的檔案形式；到期時間寫在檔案 mtime 上，重啟後仍可清理
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, file_id: str, encoding: str) -> str:
+        suffix = ".txt.gz" if encoding == "gzip" else ".txt"
+        return os.path.join(self.directory, f"{file_id}{suffix}")
+
+    def put(self, file_id, data, encoding, expires_at):
+        path = self._path(file_id, encoding)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.utime(tmp_path, (expires_at, expires_at))
+        os.replace(tmp_path, path)
+
+    def get(self, file_id):
+        now = time.time()
+        for encoding in ("gzip", "identity"):
+            path = self._path(file_id, encoding)
+            try:
+                if os.path.getmtime(path) <= now:
+                    return None
+                with open(path, "rb") as f:
+                    return f.read(), encoding
+            except FileNotFoundError:
+                continue
+        return None
+
+    def purge_expired(self, now):
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                # 寫到一半的暫存檔：mtime 可能是寫入時間或已設好的到期時間，過了門檻才刪
+                deadline = now - TMP_ORPHAN_AGE_S
+            elif name.endswith(".txt") or name.endswith(".txt.gz"):
+                deadline = now
+            else:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) <= deadline:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+def purge_legacy_files(directory: str) -> int:
+    # 非 file 後端時，資料夾裡舊版留下的 <uuid>.txt 已無人會讀取也不會被排程刪除，啟動時一併清掉
+    if not os.path.isdir(directory):
+        return 0
+    removed = 0
+    for name in os.listdir(directory):
+        if not _LEGACY_FILE_RE.match(name):
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class DownloadManager:
+
+    def __init__(self, store: DownloadStore, compress: bool = True):
+        self.store = store
+        self.compress = compress
+        self._deadlines = []  # heap of expires_at
+        self._cond = threading.Condition()
+        self._sweeper = None
+        # 啟動時清理：上次執行留下的過期檔案
+        try:
+            removed = self.store.purge_expired(time.time())
+            if removed:
+                print(f"🧹 啟動清理：刪除 {removed} 個過期下載檔")
+        except Exception as e:
+            print("download store startup cleanup failed:", e)
+            traceback.print_exc()
+
+    def save(self, file_id: str, text: str, lifetime_seconds: int) -> None:
+        raw = text.encode("utf-8")
+        if self.compress:
+            data, encoding = gzip.compress(raw), "gzip"
+        else:
+            data, encoding = raw, "identity"
+        expires_at = time.time() + lifetime_seconds
+        self.store.put(file_id, data, encoding, expires_at)
+        print(f"🕒 已儲存檔案 {file_id}（{encoding}, {len(raw)} -> {len(data)} bytes），{lifetime_seconds}s 後自動刪除")
+        self._schedule(expires_at)
+
+    def load(self, file_id: str, accept_gzip: bool) -> Optional[Tuple[bytes, str]]:
+        # 回傳 (body, content_encoding)；client 不支援 gzip 時在此解壓
+        found = self.store.get(file_id)
+        if not found:
+            return None
+        data, encoding = found
+        if encoding == "gzip" and not accept_gzip:
+            return gzip.decompress(data), "identity"
+        return data, encoding
+
+    def _schedule(self, expires_at: float):
+        with self._cond:
+            heapq.heappush(self._deadlines, expires_at)
+            if self._sweeper is None or not self._sweeper.is_alive():
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="download-sweeper")
+                self._sweeper.daemon = True
+                self._sweeper.start()
+            self._cond.notify()
+
+    def _sweep_loop(self):
+        while True:
+            with self._cond:
+                while not self._deadlines:
+                    self._cond.wait()
+                wait_s = self._deadlines[0] - time.time()
+                if wait_s > 0:
+                    self._cond.wait(timeout=wait_s)
+                    continue
+                now = time.time()
+                while self._deadlines and self._deadlines[0] <= now:
+                    heapq.heappop(self._deadlines)
+            # 一次刪除所有到期項目（也會清到其他 worker 留下的過期檔）
+            try:
+                removed = self.store.purge_expired(now)
+                if removed:
+                    print(f"🗑️ 已自動刪除 {removed} 個過期下載檔")
+            except Exception as e:
+                print("download sweeper exception:", e)
+                traceback.print_exc()
+
+
+def create_download_manager() -> DownloadManager:
+    backend = os.environ.get("DOWNLOAD_BACKEND", "sqlite").strip().lower()
+    download_dir = os.environ.get("DOWNLOAD_DIR", "/tmp/line_downloads")
+    compress = os.environ.get("DOWNLOAD_GZIP", "1") != "0"
+    if backend == "file":
+        store = LocalDirDownloadStore(download_dir)
+    elif backend == "sqlite":
+        db_path = os.environ.get("DOWNLOAD_DB_PATH", os.path.join(download_dir, "downloads.sqlite3"))
+        store = SQLiteDownloadStore(db_path)
+        try:
+            removed = purge_legacy_files(download_dir)
+            if removed:
+                print(f"🧹 啟動清理：刪除 {removed} 個舊版下載檔")
+        except Exception as e:
+            print("legacy download cleanup failed:", e)
+            traceback.print_exc()
+    else:
+        raise ValueError(f"unknown DOWNLOAD_BACKEND: {backend}")
+    print(f"📦 下載儲存後端：{backend}（gzip={compress}）")
+    return DownloadManager(store, compress=compress)
@@ -5,21 +5,54 @@ import uuid
 import time
 from typing import List, Optional
 import importlib
+import re
+from collections import OrderedDict
 
-from flask import Flask, request, jsonify, send_file, abort
+from flask import Flask, Response, request, jsonify, abort
 from linebot import LineBotApi
 from linebot.models import TextSendMessage
 from linebot.exceptions import LineBotApiError
 
+from download_store import create_download_manager
+
 app = Flask(__name__)
 
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("CHANNEL_ACCESS_TOKEN")
 RENDER_BASE_URL = os.environ.get("RENDER_BASE_URL", "").rstrip("/") 
-DOWNLOAD_DIR = "/tmp/line_downloads"
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+# 長回答下載檔：共用儲存後端 + 單一到期 sweeper（見 download_store.py）
+download_manager = create_download_manager()
 
 line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 
+# LINE 限制：單則文字 5000 UTF-16 code units，單次 push 最多 5 個 message objects
+LINE_MAX_TEXT_UTF16 = 5000
+LINE_MAX_MESSAGES_PER_PUSH = 5
+# 超過幾次 push 才改用下載連結（預設 1 次 = 最多 5 則訊息內直接回覆）
+INLINE_MAX_PUSHES = int(os.environ.get("INLINE_MAX_PUSHES", "1"))
+
+# 切段優先順序：段落 -> 換行 -> 句尾標點 -> 逗號/空白；仍過長才硬切
+_SPLIT_PATTERNS = [
+    re.compile(r"(?<=\n\n)"),
+    re.compile(r"(?<=\n)"),
+    re.compile(r"(?<=[。！？!?；;])|(?<=\.\s)"),
+    re.compile(r"(?<=[，,、：:\s])"),
+]
+
+# webhook 去重：DO 重送或 LINE redelivery 時，同一個 webhookEventId 只處理一次
+WEBHOOK_DEDUP_TTL_S = float(os.environ.get("WEBHOOK_DEDUP_TTL_S", "900"))
+WEBHOOK_DEDUP_MAX = int(os.environ.get("WEBHOOK_DEDUP_MAX", "5000"))
+_seen_event_ids = OrderedDict()  # webhookEventId -> 首次收到的時間
+_seen_lock = threading.Lock()
+
+# 同一使用者短時間內連發多則訊息時，合併成一次檢索與生成。
+# 處理中才進來的訊息一律會併入下一輪；COALESCE_WINDOW_S > 0 時，每一輪開始前會再固定等待
+# 這麼多秒收集訊息（每則訊息的回覆都會多出這段延遲），預設 0 = 不額外等待。
+COALESCE_WINDOW_S = float(os.environ.get("COALESCE_WINDOW_S", "0"))
+_pending_questions = {}  # to_id -> [question, ...]
+_active_workers = set()  # 目前有背景 worker 的 to_id
+_pending_lock = threading.Lock()
+
 # Helpers
 def utf16_len(s: str) -> int:
 
@@ -29,35 +62,115 @@ def utf16_len(s: str) -> int:
         return 0
     return len(s.encode("utf-16-le")) // 2
 
-def chunk_text_by_chars(text: str, max_len: int = 4999) -> List[str]:
+def _hard_split_utf16(text: str, max_units: int) -> List[str]:
+    # 逐字累加 UTF-16 長度切段，不會把 surrogate pair（emoji 等）切開
+    chunks = []
+    buf = []
+    buf_len = 0
+    for ch in text:
+        ch_len = 2 if ord(ch) > 0xFFFF else 1
+        if buf and buf_len + ch_len > max_units:
+            chunks.append("".join(buf))
+            buf, buf_len = [], 0
+        buf.append(ch)
+        buf_len += ch_len
+    if buf:
+        chunks.append("".join(buf))
+    return chunks
+
+def _split_atoms(text: str, max_units: int, level: int = 0) -> List[str]:
+    # 把文字拆成每塊都 <= max_units 的片段；能整段保留就不往更細的層級切
+    if utf16_len(text) <= max_units:
+        return [text]
+    if level >= len(_SPLIT_PATTERNS):
+        return _hard_split_utf16(text, max_units)
+    atoms = []
+    for piece in _SPLIT_PATTERNS[level].split(text):
+        if piece:
+            atoms.extend(_split_atoms(piece, max_units, level + 1))
+    return atoms
+
+def split_text_utf16(text: str, max_units: int = LINE_MAX_TEXT_UTF16) -> List[str]:
+
+    # 依段落/句子邊界切段並以 UTF-16 長度計算，貪婪地把片段塞滿每則訊息（訊息數最少）。
+
     if not text:
         return []
     chunks = []
-    start = 0
-    while start < len(text):
-        end = start + max_len
-        chunks.append(text[start:end])
-        start = end
-    return chunks
+    cur = ""
+    cur_len = 0
+    for atom in _split_atoms(text, max_units):
+        atom_len = utf16_len(atom)
+        if cur and cur_len + atom_len > max_units:
+            chunks.append(cur)
+            cur, cur_len = "", 0
+        cur += atom
+        cur_len += atom_len
+    if cur:
+        chunks.append(cur)
+    # LINE 不接受空白訊息
+    return [c for c in chunks if c.strip()]
 
 def _extract_target_id(ev: dict) -> Optional[str]:
     src = ev.get("source") or {}
     return src.get("userId") or src.get("groupId") or src.get("roomId")
 
-def safe_push_single(to_id: str, text: str, max_retries: int = 6, wait_s: float = 2.5):
+def _is_duplicate_event(event_id: Optional[str]) -> bool:
+
+    # 以 bounded TTL set 記錄已處理的 webhookEventId；回傳 True 代表重複事件。
+
+    if not event_id:
+        return False
+    now = time.time()
+    with _seen_lock:
+        # 依時間順序清掉過期項目，並限制總數
+        while _seen_event_ids:
+            oldest_id, ts = next(iter(_seen_event_ids.items()))
+            if now - ts > WEBHOOK_DEDUP_TTL_S or len(_seen_event_ids) >= WEBHOOK_DEDUP_MAX:
+                _seen_event_ids.popitem(last=False)
+            else:
+                break
+        if event_id in _seen_event_ids:
+            return True
+        _seen_event_ids[event_id] = now
+        return False
+
+def _forget_event(event_id: Optional[str]):
+    # 事件未能成功排入處理時移除紀錄，讓 DO 的重送不會被當成重複事件
+    if not event_id:
+        return
+    with _seen_lock:
+        _seen_event_ids.pop(event_id, None)
+
+def safe_push_messages(to_id: str, texts: List[str], max_retries: int = 6, wait_s: float = 2.5):
+
+    # 一次 push 最多 5 則文字訊息；重試以整批為單位。
+
     if not to_id:
         print("⚠️ skip push: empty to_id")
         return False
+    if not texts:
+        return True
+    if len(texts) > LINE_MAX_MESSAGES_PER_PUSH:
+        raise ValueError(f"too many messages in one push: {len(texts)} > {LINE_MAX_MESSAGES_PER_PUSH}")
+    messages = [TextSendMessage(text=t) for t in texts]
+    lens = [utf16_len(t) for t in texts]
+    # 同一批的所有重試共用一個 retry key，LINE 已收過的請求不會重複送達
+    retry_key = str(uuid.uuid4())
     for attempt in range(1, max_retries + 1):
         try:
-            line_bot_api.push_message(to_id, TextSendMessage(text=text))
-            print(f"✅ push OK -> {to_id} (len={len(text)})")
+            line_bot_api.push_message(to_id, messages, retry_key=retry_key)
+            print(f"✅ push OK -> {to_id} (messages={len(texts)}, utf16={lens})")
             return True
         except LineBotApiError as e:
             status = getattr(e, "status_code", None)
             print(f"push LineBotApiError #{attempt}/{max_retries} status={status} resp={getattr(e,'error_response',None)}")
+            if status == 409:
+                # 409：此 retry key 的請求先前已被接受（上次逾時/5xx 但其實已送達）
+                print(f"✅ push 已送達（retry key 重複）-> {to_id}")
+                return True
             if status and 400 <= status < 500:
-                print("🛑 client error，停止重試此段")
+                print("🛑 client error，停止重試此批")
                 return False
         except Exception as e:
             print(f"push exception #{attempt}/{max_retries}: {e}")
@@ -66,43 +179,31 @@ def safe_push_single(to_id: str, text: str, max_retries: int = 6, wait_s: float
     print("❌ push 最後仍失敗")
     return False
 
-# 刪除檔案（由 timer 呼叫）
-def _delete_download_file(file_id: str):
-    try:
-        txt_path = os.path.join(DOWNLOAD_DIR, f"{file_id}.txt")
-        if os.path.exists(txt_path):
-            os.remove(txt_path)
-            print(f"🗑️ 已自動刪除檔案 {txt_path}")
-    except Exception as e:
-        print("delete_download_file exception:", e)
-        traceback.print_exc()
+def safe_push_single(to_id: str, text: str, max_retries: int = 6, wait_s: float = 2.5):
+    return safe_push_messages(to_id, [text], max_retries=max_retries, wait_s=wait_s)
+
+def push_text_batched(to_id: str, chunks: List[str]) -> bool:
+    # 每 5 段打包成一次 push；任一批重試後仍失敗即停止（後續批次不再送出）
+    for i in range(0, len(chunks), LINE_MAX_MESSAGES_PER_PUSH):
+        batch = chunks[i:i + LINE_MAX_MESSAGES_PER_PUSH]
+        if not safe_push_messages(to_id, batch):
+            print(f"❌ 第 {i // LINE_MAX_MESSAGES_PER_PUSH + 1} 批 push 失敗")
+            return False
+    return True
 
 def save_text_and_get_url(text: str, lifetime_seconds: int = 600) -> str:
 
-    # 儲存檔案並排程在 lifetime_seconds 後自動刪除（使用 threading.Timer）
+    # 儲存檔案並登記到期時間（由 download_manager 的 sweeper 統一刪除）
     # 回傳可由 /download/<id> 存取的 URL。
 
     file_id = str(uuid.uuid4())
-    filename = f"{file_id}.txt"
-    path = os.path.join(DOWNLOAD_DIR, filename)
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(text)
+        download_manager.save(file_id, text, lifetime_seconds)
     except Exception as e:
         print("save_text_and_get_url write fail:", e)
         traceback.print_exc()
         raise
 
-    # 啟動單次 Timer，在到期時刪除檔案
-    try:
-        timer = threading.Timer(lifetime_seconds, _delete_download_file, args=(file_id,))
-        timer.daemon = True
-        timer.start()
-        print(f"🕒 已排程檔案 {file_id} 在 {lifetime_seconds}s 後自動刪除")
-    except Exception as e:
-        print("save_text_and_get_url timer start failed:", e)
-        traceback.print_exc()
-
     if not RENDER_BASE_URL:
         print("⚠️ RENDER_BASE_URL not set; download URL will be local path (not accessible externally)")
         return f"/download/{file_id}"
@@ -134,20 +235,26 @@ def background_process_and_push(question: str, target_id: str):
             return
 
         ulen = utf16_len(answer)
-        print(f"回答 UTF-16 長度：{ulen}")
-
-        if ulen <= 5000:
-            ok = safe_push_single(target_id, answer)
-            if not ok:
-                parts = chunk_text_by_chars(answer, 4000)
-                for p in parts:
-                    safe_push_single(target_id, p)
+        chunks = split_text_utf16(answer, LINE_MAX_TEXT_UTF16)
+        print(f"回答 UTF-16 長度：{ulen}，切成 {len(chunks)} 則訊息")
+
+        if len(chunks) <= LINE_MAX_MESSAGES_PER_PUSH * INLINE_MAX_PUSHES:
+            # 每批在 safe_push_messages 內已各自重試；仍失敗時只補一則簡短錯誤，不重送已送達的內容
+            if not push_text_batched(target_id, chunks):
+                safe_push_single(target_id, "❌ 回覆傳送失敗，部分內容可能未送達，請稍後再試。")
         else:
             download_url = save_text_and_get_url(answer, lifetime_seconds=600)  # 10 分鐘
             snippet = answer[:1500]
             msg = f"📄 回答內容太長，請點此下載完整回答（連結 10 分鐘後失效）：\n{download_url}\n\n（預覽）\n{snippet}...\n"
             safe_push_single(target_id, msg)
 
+        # 回答已推送，再於背景摘要記憶（MEMORY_MODE=async 時才會實際執行）
+        try:
+            main.schedule_memory_summary(target_id or "default")
+        except Exception as e:
+            print("schedule_memory_summary 失敗：", e)
+            traceback.print_exc()
+
     except Exception as e:
         print("background_process_and_push 例外：", e)
         traceback.print_exc()
@@ -157,6 +264,42 @@ def background_process_and_push(question: str, target_id: str):
         except Exception:
             pass
 
+def _coalesce_worker(to_id: str):
+
+    # 每個 to_id 同時只有一個 worker：等待合併視窗後取出累積的訊息，合併成一題處理；
+    # 處理期間又有新訊息進來則繼續下一輪，直到沒有待處理訊息才結束。
+
+    while True:
+        if COALESCE_WINDOW_S > 0:
+            time.sleep(COALESCE_WINDOW_S)
+        with _pending_lock:
+            questions = _pending_questions.pop(to_id, [])
+            if not questions:
+                _active_workers.discard(to_id)
+                return
+        if len(questions) > 1:
+            print(f"🧩 合併 {to_id} 的 {len(questions)} 則訊息為一次處理")
+        background_process_and_push("\n".join(questions), to_id)
+
+def _enqueue_question(to_id: str, question: str) -> bool:
+    # 回傳 True 代表為此 to_id 新啟動了 worker（訊息會開啟新一輪處理）
+    with _pending_lock:
+        _pending_questions.setdefault(to_id, []).append(question)
+        if to_id in _active_workers:
+            return False
+        _active_workers.add(to_id)
+    try:
+        t = threading.Thread(target=_coalesce_worker, args=(to_id,))
+        t.daemon = False
+        t.start()
+    except Exception:
+        # worker 沒起來：還原狀態，否則此 to_id 之後的訊息會永遠排隊沒人處理
+        with _pending_lock:
+            _active_workers.discard(to_id)
+            _pending_questions.pop(to_id, None)
+        raise
+    return True
+
 # Webhook route (由 Worker/DO 轉送)
 @app.route("/callback", methods=["POST"])
 def callback():
@@ -171,7 +314,9 @@ def callback():
         return jsonify({"status": "no body"}), 400
 
     events = body.get("events", [])
+    failed = False
     for ev in events:
+        event_id = None
         try:
             if ev.get("type") != "message":
                 continue
@@ -183,37 +328,56 @@ def callback():
             if question == "名單":
                 continue
 
+            event_id = ev.get("webhookEventId")
+            if _is_duplicate_event(event_id):
+                redelivery = (ev.get("deliveryContext") or {}).get("isRedelivery")
+                print(f"♻️ 重複事件 {event_id}（isRedelivery={redelivery}），跳過")
+                continue
+
             to_id = _extract_target_id(ev)
             if not to_id:
                 print("⚠️ 無有效 target id，跳過")
                 continue
 
-            if thinking_sent != "1":
+            started = _enqueue_question(to_id, question)
+
+            # 同一輪合併處理只補發一次 thinking，併入既有 worker 的訊息不再重複推送
+            if started and thinking_sent != "1":
                 try:
                     safe_push_single(to_id, "📊 思考分析中，請稍候...")
                 except Exception as e:
                     print("後端補發 thinking 失敗：", e)
                     traceback.print_exc()
 
-            t = threading.Thread(target=background_process_and_push, args=(question, to_id))
-            t.daemon = False
-            t.start()
-
         except Exception as e:
             print("處理 event 發生錯誤：", e)
             traceback.print_exc()
+            _forget_event(event_id)
+            failed = True
 
+    if failed:
+        # 回非 2xx 讓 DO 重送；已成功排入的事件重送時會被去重略過
+        return "retry", 500
     return "OK", 200
 
 
 # 下載 endpoint（使用者點連結時由 Render 提供檔案）
 @app.route("/download/<file_id>", methods=["GET"])
 def download_file(file_id):
-    txt_path = os.path.join(DOWNLOAD_DIR, f"{file_id}.txt")
-    if not os.path.exists(txt_path):
+    # 用 Werkzeug 解析過的 Accept-Encoding（含 q 值），gzip;q=0 代表不接受
+    accept_gzip = request.accept_encodings["gzip"] > 0
+    found = download_manager.load(file_id, accept_gzip=accept_gzip)
+    if not found:
+        # 不存在或已過期
         return abort(404)
-    # 直接回傳檔案（若檔案已被 timer 刪除則 404）
-    return send_file(txt_path, mimetype="text/plain", as_attachment=True, download_name=f"answer_{file_id}.txt")
+    body, encoding = found
+    headers = {
+        "Content-Disposition": f'attachment; filename="answer_{file_id}.txt"',
+        "Vary": "Accept-Encoding",
+    }
+    if encoding == "gzip":
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, mimetype="text/plain; charset=utf-8", headers=headers)
 
 @app.route("/", methods=["GET"])
 def home():